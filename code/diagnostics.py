@@ -0,0 +1,426 @@
+# Diagnostics for the indicator
+# Provides an opt-in main loop watchdog and callback profiling hooks.
+# Both are disabled unless enabled with the environment variables below:
+#
+#   NORDVPN_INDICATOR_WATCHDOG=<seconds>  report main loop stalls longer than <seconds>
+#   NORDVPN_INDICATOR_PROFILE=1           profile startup and callbacks with cProfile
+#   NORDVPN_INDICATOR_REPORT_DIR=<path>   where reports are written
+#                                         (default: $XDG_CACHE_HOME/nordvpn_indicator)
+#
+# Failures of the diagnostics are reported on stderr and never affect the
+# observed callbacks.
+
+import cProfile
+import functools
+import os
+import pstats
+import stat
+import sys
+import threading
+import time
+import traceback
+
+from gi.repository import GLib
+
+
+WATCHDOG_ENV = 'NORDVPN_INDICATOR_WATCHDOG'
+PROFILE_ENV = 'NORDVPN_INDICATOR_PROFILE'
+REPORT_DIR_ENV = 'NORDVPN_INDICATOR_REPORT_DIR'
+HEARTBEAT_MS = 100
+FLUSH_SECONDS = 60.0
+STALL_LOG = 'stalls.log'
+TIMINGS_REPORT = 'timings.txt'
+
+
+def warn(message):
+    """
+    Writes a diagnostics message on stderr
+    """
+    try:
+        sys.stderr.write(message + '\n')
+    except Exception:
+        pass
+
+
+def _create_report_dir():
+    """
+    Creates the report directory and checks that only the current user can
+    access it. Raises OSError if the directory can't be used safely
+    """
+    path = os.environ.get(REPORT_DIR_ENV)
+    if not path:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        path = os.path.join(cache, 'nordvpn_indicator')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise OSError('{} is not a directory owned by the current user'.format(path))
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+_report_dir = None
+_report_dir_resolved = False
+_report_dir_lock = threading.Lock()
+
+
+def get_report_dir():
+    """
+    Returns the directory where the reports are written, or None if it
+    can't be used. The directory is resolved only once
+    """
+    global _report_dir, _report_dir_resolved
+    with _report_dir_lock:
+        if not _report_dir_resolved:
+            _report_dir_resolved = True
+            try:
+                _report_dir = _create_report_dir()
+            except OSError as e:
+                warn('Diagnostics reports disabled: {}'.format(e))
+        return _report_dir
+
+
+def profiling_enabled():
+    """
+    Returns True if callback profiling has been enabled in the environment
+    """
+    return os.environ.get(PROFILE_ENV, '') not in ('', '0')
+
+
+def get_watchdog_threshold():
+    """
+    Returns the stall threshold in seconds set in the environment, or None
+    if the watchdog is disabled
+    """
+    value = os.environ.get(WATCHDOG_ENV, '')
+    try:
+        threshold = float(value)
+    except ValueError:
+        return None
+    return threshold if threshold > 0 else None
+
+
+class MainLoopWatchdog(object):
+    """
+    Measures the GTK main loop latency with a heartbeat scheduled on the
+    main loop and checked from a background thread. When the heartbeat is
+    late by more than the threshold, the stack of the main thread is written
+    to the stall log so the blocking call can be identified.
+
+    Args:
+        threshold: stall duration in seconds that triggers a report
+        report_dir: directory where the stall log is written, if None
+                    reports are only written on stderr
+
+    Returns:
+        Instance of MainLoopWatchdog class
+    """
+    def __init__(self, threshold, report_dir):
+        self.threshold = threshold
+        self.log_path = os.path.join(report_dir, STALL_LOG) if report_dir else None
+        self.interval = HEARTBEAT_MS / 1000.0
+        self.main_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.max_latency = 0.0
+        self.stall_reported = False
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        """
+        Schedules the heartbeat and starts the monitoring thread.
+        Must be called from the thread running the GTK main loop
+        """
+        self.main_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.running = True
+        GLib.timeout_add(HEARTBEAT_MS, self._beat)
+        thread = threading.Thread(target=self._monitor, name='watchdog', daemon=True)
+        thread.start()
+
+    def stop(self):
+        """
+        Stops the heartbeat and the monitoring thread
+        """
+        self.running = False
+
+    def _beat(self):
+        """
+        Heartbeat executed by the main loop. Records the latency and notes
+        the end of a previously reported stall
+        """
+        now = time.monotonic()
+        with self.lock:
+            latency = max(0.0, now - self.last_beat - self.interval)
+            self.max_latency = max(self.max_latency, latency)
+            self.last_beat = now
+            if self.stall_reported:
+                self.stall_reported = False
+                self._write('{} Main loop resumed after {:.3f}s (max latency {:.3f}s)\n'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'), latency, self.max_latency))
+        return self.running
+
+    def _monitor(self):
+        """
+        Background loop that captures the main thread stack when the
+        heartbeat is late
+        """
+        while self.running:
+            time.sleep(self.interval)
+            with self.lock:
+                lag = time.monotonic() - self.last_beat - self.interval
+                if lag < self.threshold or self.stall_reported:
+                    continue
+                self.stall_reported = True
+            frame = sys._current_frames().get(self.main_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'Unavailable\n'
+            self._write('{} Main loop stalled for {:.3f}s, main thread stack:\n{}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), lag, stack))
+
+    def _write(self, message):
+        """
+        Appends the message to the stall log and echoes it on stderr
+        """
+        warn(message.rstrip('\n'))
+        if self.log_path is None:
+            return
+        try:
+            with open(self.log_path, 'a') as log:
+                log.write(message)
+        except OSError as e:
+            warn('Unable to write {}: {}'.format(self.log_path, e))
+
+
+class ProfiledCall(object):
+    """
+    A profiled callback running on the main thread
+
+    Args:
+        profile: cProfile.Profile of the call
+
+    Returns:
+        Instance of ProfiledCall class
+    """
+    def __init__(self, profile):
+        self.profile = profile
+        # Profiles of the nested profiled calls
+        self.nested = []
+        # Time spent by the profiler in the nested calls, excluded from timings
+        self.overhead = 0.0
+
+
+class CallbackProfiler(object):
+    """
+    Profiles named callbacks with cProfile and keeps the timing of every
+    call. Only calls on the main thread, which runs the GTK main loop, are
+    profiled: calls from other threads, like the status check timer, are
+    only timed. Since Python 3.12 cProfile observes every thread, so the
+    profile of a callback also contains the work of other threads running
+    at the same time.
+    A callback called by another profiled callback gets its own profile,
+    which is also included in the profile of the caller. The cumulative
+    profile of each callback is saved as <name>.prof together with the
+    timing summary of all callbacks every FLUSH_SECONDS and when flush()
+    is called.
+
+    Args:
+        report_dir: directory where the reports are written
+
+    Returns:
+        Instance of CallbackProfiler class
+    """
+    def __init__(self, report_dir):
+        self.report_dir = report_dir
+        self.stats = dict()
+        self.timings = dict()
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+        # Running profiled calls on the main thread, innermost last
+        self.stack = []
+        self.lock = threading.Lock()
+
+    def call(self, name, function, *args, **kwargs):
+        """
+        Runs the function profiling it under the given name
+        """
+        begin = time.perf_counter()
+        call = None
+        if threading.current_thread() is threading.main_thread():
+            call = self._begin()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._end(name, elapsed, call, start - begin)
+
+    def flush(self):
+        """
+        Writes the profiles and the timing summary
+        """
+        with self.lock:
+            self._flush()
+
+    def _begin(self):
+        """
+        Pauses the profile of the enclosing call and starts a new one.
+        Returns the ProfiledCall, or None if the profiler can't be started
+        """
+        call = None
+        try:
+            call = ProfiledCall(cProfile.Profile())
+            if self.stack:
+                self.stack[-1].profile.disable()
+            self.stack.append(call)
+            call.profile.enable()
+            return call
+        except Exception as e:
+            warn('Unable to start profiler: {}'.format(e))
+            if self.stack and self.stack[-1] is call:
+                self.stack.pop()
+            self._resume()
+            return None
+
+    def _end(self, name, elapsed, call, begin_overhead):
+        """
+        Stops the profile of a call and records it, then resumes the profile
+        of the enclosing call excluding the time spent by the profiler
+        """
+        end = time.perf_counter()
+        profiles = []
+        try:
+            if call is not None:
+                call.profile.disable()
+                self.stack.remove(call)
+                elapsed -= call.overhead
+                profiles = [call.profile] + call.nested
+                if self.stack:
+                    self.stack[-1].nested.extend(profiles)
+            nested = (threading.current_thread() is threading.main_thread()
+                      and len(self.stack) > 0)
+            self._record(name, elapsed, profiles, not nested)
+        except Exception as e:
+            warn('Unable to profile {}: {}'.format(name, e))
+        if call is not None and self.stack:
+            self.stack[-1].overhead += (call.overhead + begin_overhead +
+                                        time.perf_counter() - end)
+        self._resume()
+
+    def _resume(self):
+        """
+        Resumes the profile of the innermost running call
+        """
+        if threading.current_thread() is not threading.main_thread() or not self.stack:
+            return
+        try:
+            self.stack[-1].profile.enable()
+        except Exception as e:
+            warn('Unable to resume profiler: {}'.format(e))
+
+    def _record(self, name, elapsed, profiles, flush):
+        """
+        Stores the result of a profiled call. If flush is True, the reports
+        are written when FLUSH_SECONDS have passed since the last time
+        """
+        with self.lock:
+            count, total, worst = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + elapsed, max(worst, elapsed))
+            for profile in profiles:
+                if name in self.stats:
+                    self.stats[name].add(profile)
+                else:
+                    self.stats[name] = pstats.Stats(profile)
+                self.dirty.add(name)
+            if flush and time.monotonic() - self.last_flush >= FLUSH_SECONDS:
+                self._flush()
+
+    def _flush(self):
+        """
+        Writes the updated profiles and the timing summary of all callbacks,
+        slowest first
+        """
+        self.last_flush = time.monotonic()
+        try:
+            for name in self.dirty:
+                self.stats[name].dump_stats(
+                    os.path.join(self.report_dir, '{}.prof'.format(name)))
+            self.dirty.clear()
+            rows = sorted(self.timings.items(), key=lambda item: item[1][1], reverse=True)
+            with open(os.path.join(self.report_dir, TIMINGS_REPORT), 'w') as report:
+                report.write('{:<40} {:>8} {:>12} {:>12} {:>12}\n'.format(
+                    'callback', 'calls', 'total (s)', 'mean (s)', 'max (s)'))
+                for name, (count, total, worst) in rows:
+                    report.write('{:<40} {:>8} {:>12.4f} {:>12.4f} {:>12.4f}\n'.format(
+                        name, count, total, total / count, worst))
+        except OSError as e:
+            warn('Unable to write profiling reports: {}'.format(e))
+
+
+_profiler = None
+_profiler_resolved = False
+_watchdog = None
+_lock = threading.Lock()
+
+
+def get_profiler():
+    """
+    Returns the shared CallbackProfiler, or None if the reports can't be
+    written. The profiler is created on first use
+    """
+    global _profiler, _profiler_resolved
+    if _profiler_resolved:
+        return _profiler
+    report_dir = get_report_dir()
+    with _lock:
+        if not _profiler_resolved:
+            if report_dir is not None:
+                _profiler = CallbackProfiler(report_dir)
+            _profiler_resolved = True
+        return _profiler
+
+
+def profiled(function):
+    """
+    Decorator that profiles the function when profiling is enabled in the
+    environment, otherwise the function is returned unchanged
+    """
+    if not profiling_enabled():
+        return function
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = get_profiler()
+        if profiler is None:
+            return function(*args, **kwargs)
+        return profiler.call(name, function, *args, **kwargs)
+    return wrapper
+
+
+def start_watchdog():
+    """
+    Starts the main loop watchdog if enabled in the environment.
+    Returns the MainLoopWatchdog instance or None
+    """
+    global _watchdog
+    threshold = get_watchdog_threshold()
+    if threshold is None:
+        return None
+    with _lock:
+        if _watchdog is None:
+            _watchdog = MainLoopWatchdog(threshold, get_report_dir())
+            _watchdog.start()
+        return _watchdog
+
+
+def stop_diagnostics():
+    """
+    Stops the watchdog and writes the final profiling reports
+    """
+    with _lock:
+        watchdog, profiler = _watchdog, _profiler
+    if watchdog is not None:
+        watchdog.stop()
+    if profiler is not None:
+        profiler.flush()
@@ -16,6 +16,7 @@ from gi.repository import Gtk as gtk
 from gi.repository import AppIndicator3 as appindicator
 
 from nordvpn import NordVPN, ConnectionStatus, NordVPNStatus
+from diagnostics import profiled, start_watchdog, stop_diagnostics
 
 
 APPINDICATOR_ID = 'nordvpn_tray_icon'
@@ -46,7 +47,6 @@ class Indicator(object):
 
         # Set recurrent timer for checking VPN status
         self.status_check_loop()
-        gtk.main()
 
     def status_check_loop(self):
         """
@@ -56,6 +56,7 @@ class Indicator(object):
         self.timer = threading.Timer(TIMER_SECONDS, self.status_check_loop)
         self.timer.start()
 
+    @profiled
     def update(self):
         """
         Updates the icon and the menu status item
@@ -80,6 +81,7 @@ class Indicator(object):
             filename = 'nordvpn_waiting.png'
         return os.path.dirname(os.path.realpath(__file__)) + '/' + filename
 
+    @profiled
     def build_menu(self):
         """
         Builds menu for the tray icon
@@ -170,8 +172,10 @@ class Indicator(object):
         in quitting the application
         """
         self.timer.cancel()
+        stop_diagnostics()
         gtk.main_quit()
 
+    @profiled
     def country_connect_cb(self, btn_toggled):
         """
         Callback function to handle the connection of a selected country
@@ -179,6 +183,7 @@ class Indicator(object):
         self.nordvpn.disconnect(None)
         self.nordvpn.connect_to_country(btn_toggled.get_label())
 
+    @profiled
     def auto_connect_cb(self, _):
         """
         Callback to handle connection to auto server
@@ -186,6 +191,7 @@ class Indicator(object):
         self.nordvpn.disconnect(None)
         self.nordvpn.connect(None)
 
+    @profiled
     def display_settings_window(self, widget):
         """
         Display a new window showing the settings of the NordVPN client app
@@ -193,6 +199,7 @@ class Indicator(object):
         window = SettingsWindow(self.nordvpn)
         window.show_all()
 
+    @profiled
     def group_connect_cb(self, menu_item):
         """
         Callback to connect to a server group
@@ -200,6 +207,7 @@ class Indicator(object):
         self.nordvpn.disconnect(None)
         self.nordvpn.connect_to_group(menu_item.get_label())
 
+    @profiled
     def city_connect_cb(self, menu_item):
         """
         Callback to connet to a city server
@@ -230,6 +238,7 @@ class SettingsWindow(gtk.Window):
         # Build window layout
         self.add(self.create_widgets())
 
+    @profiled
     def create_widgets(self):
         # TODO start a timer that keep updating the settings
         settings = self.nordvpn.get_settings()
@@ -299,6 +308,7 @@ class SettingsWindow(gtk.Window):
     def on_setting_selection(self, widget):
         self.selected_setting = widget.get_active_text()
 
+    @profiled
     def on_apply(self, widget):
         output = self.nordvpn.set_setting(self.selected_setting, self.entry_set.get_text())
         # Show output in window
@@ -316,7 +326,9 @@ def main():
     Signal for allowing Ctrl+C interrupts
     """
     signal.signal(signal.SIGINT, signal.SIG_DFL)
-    Indicator(NordVPN())
+    profiled(Indicator)(NordVPN())
+    start_watchdog()
+    gtk.main()
 
 if __name__ == '__main__':
     main()